@@ -2,20 +2,34 @@ import os
 import re
 import uuid
 import tempfile
+import time
+import io
 import smtplib
-import json
 import socket
-from typing import Dict, Any, Tuple
+import threading
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Tuple, Awaitable
 from email.message import EmailMessage
 from dotenv import load_dotenv
 from flask import (
     Flask, render_template, request, redirect, url_for,
     send_file, flash, session
 )
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import pandas as pd
-from sqlalchemy import create_engine
+import numpy as np
+import faiss
+from sentence_transformers import SentenceTransformer
+from cachetools import TTLCache, LRUCache
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from langchain_groq import ChatGroq
 from langchain.prompts import ChatPromptTemplate
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 
 # -----------------------------
 # 1) Load config
@@ -33,29 +47,95 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 UPSTREAM_EMAIL = os.getenv("UPSTREAM_EMAIL")
+UPSTREAM_RECIPIENTS = [e.strip() for e in (UPSTREAM_EMAIL or "").split(",") if e.strip()]
+SMTP_DEBUG = str(os.getenv("SMTP_DEBUG", "0")).strip() in {"1", "true", "yes"}
+
+def _smtp_attempts() -> tuple:
+    # If user explicitly set port or SSL, respect it; else try SSL:465 then STARTTLS:587
+    host = SMTP_HOST or "smtp.gmail.com"
+    env_use_ssl = os.getenv("SMTP_USE_SSL")
+    env_port = os.getenv("SMTP_PORT")
+    if env_port or env_use_ssl is not None:
+        use_ssl = str(env_use_ssl or "").lower() in {"1", "true", "yes"}
+        port = int(env_port) if env_port else (465 if use_ssl else 587)
+        return ((use_ssl, host, port),)
+    return (
+        (True, host, 465),   # SSL first (matches working code)
+        (False, host, 587),  # STARTTLS fallback
+    )
+
+SMTP_ATTEMPTS = _smtp_attempts()
 
 if not GROQ_API_KEY:
     raise ValueError("GROQ_API_KEY missing in .env")
 if not DB_URI:
     raise ValueError("DB_URI missing in .env")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider (session cookie, jsonify) backed by orjson."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = FLASK_SECRET_KEY
 
 OUT_DIR = os.path.join(tempfile.gettempdir(), "ai_it_support_outputs")
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# Flask runs each async view on a throwaway event loop, so loop-bound clients
+# (aiomysql pool, Groq's async HTTP client) live on this long-lived loop instead.
+# Under WSGI each request still holds its worker thread; this loop only lets the
+# clients and the micro-batcher be shared, it does not add request concurrency.
+# Keep CPU-bound work (DataFrame building, embeddings) off it.
+IO_LOOP = asyncio.new_event_loop()
+threading.Thread(target=IO_LOOP.run_forever, name="io-loop", daemon=True).start()
+
+def run_on_io_loop(coro) -> Awaitable:
+    """Schedule `coro` on IO_LOOP and return an awaitable for the calling loop."""
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, IO_LOOP))
+
 # -----------------------------
 # 2) DB connection helper
 # -----------------------------
-def run_sql_to_df(sql: str) -> pd.DataFrame:
-    engine = create_engine(DB_URI)
-    df = pd.read_sql(sql, engine)
+# One pooled engine for the whole process; pre_ping/recycle guard against
+# MySQL dropping idle connections (wait_timeout).
+ENGINE = create_async_engine(
+    make_url(DB_URI).set(drivername="mysql+aiomysql"),
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+
+async def _fetch_rows(sql: str) -> Tuple[list, list]:
+    async with ENGINE.connect() as conn:
+        # Driver-level execution: no SQLAlchemy bind parsing of ":word" in generated SQL
+        result = await conn.exec_driver_sql(sql)
+        return list(result.keys()), result.fetchall()
+
+def _rows_to_df(columns: list, rows: list) -> pd.DataFrame:
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+async def run_sql_to_df(sql: str) -> pd.DataFrame:
+    # Only the fetch runs on IO_LOOP; the DataFrame is built in a worker thread
+    columns, rows = await run_on_io_loop(_fetch_rows(sql))
+    df = await asyncio.get_running_loop().run_in_executor(None, _rows_to_df, columns, rows)
     return df
 
 # -----------------------------
 # 3) LLM (Groq)
 # -----------------------------
+# Persistent exact-match cache: identical prompts never hit Groq twice.
+set_llm_cache(SQLiteCache(database_path=os.path.join(OUT_DIR, "llm_cache.sqlite")))
+
 llm = ChatGroq(
     groq_api_key=GROQ_API_KEY,
     model_name=GROQ_MODEL,
@@ -71,9 +151,20 @@ WRITE_PATTERN = re.compile(
 )
 
 def is_safe_sql(sql: str) -> bool:
-    if WRITE_PATTERN.search(sql):
-        return False
-    return sql.strip().upper().startswith("SELECT")
+    # Cheap prefix check first; only scan the whole query if it starts with SELECT
+    return sql.lstrip()[:6].upper() == "SELECT" and not WRITE_PATTERN.search(sql)
+
+# Only a LIMIT closing the statement counts; one in a subquery or string
+# literal doesn't bound the outer query.
+LIMIT_PATTERN = re.compile(r"\blimit\s+\d+(\s*(,|offset)\s*\d+)?\s*;?\s*$", re.IGNORECASE)
+DEFAULT_ROW_LIMIT = 1000
+
+def ensure_limit(sql: str) -> str:
+    """Append LIMIT if the LLM left it out, so result sets stay bounded."""
+    if LIMIT_PATTERN.search(sql):
+        return sql
+    # New line so a trailing "--" or "#" comment can't swallow the LIMIT
+    return f"{sql.rstrip().rstrip(';').rstrip()}\nLIMIT {DEFAULT_ROW_LIMIT}"
 
 # -----------------------------
 # 5) Table detection (Enhanced)
@@ -95,26 +186,59 @@ INVENTORY_KEYWORDS = {
     "inventory", "stock", "qty_on_hand", "qty_allocated", "availability", "balance"
 }
 
+def _split_keywords(keywords) -> Tuple[frozenset, tuple]:
+    # Single words are matched by set intersection; multi-word phrases
+    # ("order header") match when all of their words appear.
+    words = frozenset(k for k in keywords if " " not in k)
+    phrases = tuple(frozenset(k.split()) for k in keywords if " " in k)
+    return words, phrases
+
+ORDER_TERMS = _split_keywords(ORDER_KEYWORDS)
+SKU_TERMS = _split_keywords(SKU_KEYWORDS)
+LOCATION_TERMS = _split_keywords(LOCATION_KEYWORDS)
+INVENTORY_TERMS = _split_keywords(INVENTORY_KEYWORDS)
+
+TOKEN_PATTERN = re.compile(r"[a-z_]+")
+
+def _question_tokens(question: str) -> set:
+    # Also add stems for common suffixes ("locations", "statuses", "ordered",
+    # "stocking") so they still match, as they did with the old substring checks.
+    tokens = set(TOKEN_PATTERN.findall(question.lower()))
+    for t in list(tokens):
+        for suffix in ("es", "s", "ed", "ing"):
+            if t.endswith(suffix):
+                tokens.add(t[:-len(suffix)])
+    return tokens
+
+def _mentions(tokens: set, terms: Tuple[frozenset, tuple]) -> bool:
+    words, phrases = terms
+    return not words.isdisjoint(tokens) or any(p <= tokens for p in phrases)
+
 def detect_table(question: str) -> str:
     """Detects which primary table(s) the query likely involves."""
-    q = question.lower()
+    tokens = _question_tokens(question)
+
+    has_order = _mentions(tokens, ORDER_TERMS)
+    has_sku = _mentions(tokens, SKU_TERMS)
+    has_location = _mentions(tokens, LOCATION_TERMS)
+    has_inventory = _mentions(tokens, INVENTORY_TERMS)
 
-    if any(k in q for k in ORDER_KEYWORDS):
-        if any(k in q for k in SKU_KEYWORDS):
+    if has_order:
+        if has_sku:
             return "order_header JOIN order_line"
         return "order_header"
 
-    if any(k in q for k in SKU_KEYWORDS):
-        if any(k in q for k in INVENTORY_KEYWORDS):
+    if has_sku:
+        if has_inventory:
             return "sku JOIN inventory"
         return "sku"
 
-    if any(k in q for k in LOCATION_KEYWORDS):
-        if any(k in q for k in INVENTORY_KEYWORDS):
+    if has_location:
+        if has_inventory:
             return "location JOIN inventory"
         return "location"
 
-    if any(k in q for k in INVENTORY_KEYWORDS):
+    if has_inventory:
         return "inventory"
 
     return "order_header"
@@ -152,17 +276,192 @@ Return ONLY the SQL query without explanation.
 """
     return system_text
 
+# Built once: a byte-identical static prefix lets Groq reuse its prompt cache,
+# with the per-request question kept at the very end.
+SYSTEM_PROMPT = build_sql_prompt()
+SQL_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT),
+    ("user", "User question: {question}\n\nReturn ONLY the SQL query.")
+])
+# Same static prefix, several questions answered in one call (see micro-batcher below)
+SQL_BATCH_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT),
+    ("user",
+     "Answer each numbered user question with one SQL query.\n"
+     "For question N, output a line \"### N\" followed by ONLY its SQL query.\n\n"
+     "User questions:\n{questions}")
+])
+
 # -----------------------------
 # 7) SQL generation
 # -----------------------------
-def generate_sql_for_question(question: str) -> str:
-    sys_prompt = build_sql_prompt()
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", sys_prompt),
-        ("user", f"User question: {question}\n\nReturn ONLY the SQL query.")
-    ])
-    resp = (prompt | llm).invoke({"question": question})
-    sql = resp.content.strip()
+# Only touched from IO_LOOP, so no lock is needed
+SQL_CACHE: Dict[str, str] = LRUCache(maxsize=1024)
+
+# Semantic cache: paraphrased questions reuse SQL generated for a close neighbour.
+# Vectors are L2-normalized, so inner product == cosine similarity.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX = 10_000
+EMBEDDER = SentenceTransformer("all-MiniLM-L6-v2")
+SEMANTIC_INDEX = faiss.IndexFlatIP(EMBEDDER.get_sentence_embedding_dimension())
+SEMANTIC_CACHE_CANDIDATES = 5
+SEMANTIC_SQL: list = []  # row i of SEMANTIC_INDEX -> (literals, SQL)
+
+# Quoted strings, numbers and codes containing digits (ORD123, 2024-05-01).
+# Embeddings barely separate "customer 123" from "customer 124", so a semantic
+# hit also needs these to match exactly.
+LITERAL_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"|\d+\.\d+|\b\w*\d\w*\b")
+
+def _question_literals(question: str) -> tuple:
+    return tuple(sorted(LITERAL_PATTERN.findall(question)))
+
+def _embed(question: str) -> np.ndarray:
+    return EMBEDDER.encode([question], normalize_embeddings=True).astype("float32")
+
+def _semantic_lookup(vec: np.ndarray, literals: tuple):
+    if SEMANTIC_INDEX.ntotal == 0:
+        return None
+    scores, ids = SEMANTIC_INDEX.search(vec, SEMANTIC_CACHE_CANDIDATES)
+    for score, idx in zip(scores[0], ids[0]):
+        if idx < 0 or score < SEMANTIC_CACHE_THRESHOLD:
+            break
+        cached_literals, sql = SEMANTIC_SQL[idx]
+        if cached_literals == literals:
+            return sql
+    return None
+
+def _semantic_store(vec: np.ndarray, literals: tuple, sql: str) -> None:
+    # Only remember SQL we'd actually run; the flat index is append-only, so stop at the cap
+    if not is_safe_sql(sql) or SEMANTIC_INDEX.ntotal >= SEMANTIC_CACHE_MAX:
+        return
+    SEMANTIC_INDEX.add(vec)
+    SEMANTIC_SQL.append((literals, sql))
+
+async def generate_sql_for_question(question: str) -> str:
+    # Key on the question as typed (whitespace collapsed, case kept): literals
+    # like 'ABC' vs 'abc' can select different rows on case-sensitive collations.
+    question = question.strip()
+    key = " ".join(question.split())
+    return await run_on_io_loop(_cached_generate_sql(key, question))
+
+async def _cached_generate_sql(key: str, question: str) -> str:
+    sql = SQL_CACHE.get(key)
+    if sql is not None:
+        return sql
+
+    # Embedding is CPU-bound; keep it off the IO loop
+    vec = await asyncio.get_running_loop().run_in_executor(None, _embed, question)
+    literals = _question_literals(question)
+    sql = _semantic_lookup(vec, literals)
+    if sql is not None:
+        # Not stored under this key: a false positive ("shipped today" vs
+        # "yesterday") must not stick to this exact question.
+        return sql
+
+    sql, batched = await _generate_sql(question)
+    # A batched answer is only matched to its question by the model's numbering
+    # (and shares a prompt with other users' text), so never cache it for others.
+    if not batched:
+        _semantic_store(vec, literals, sql)
+        SQL_CACHE[key] = sql
+    return sql
+
+# Micro-batcher: while a Groq call is in flight, new questions wait up to
+# LLM_BATCH_WINDOW seconds and go out together. With nothing in flight a
+# question is sent immediately, so a lone request pays no extra latency.
+# State below is only touched from IO_LOOP.
+LLM_BATCH_WINDOW = 0.02
+LLM_BATCH_MAX = 8
+_LLM_PENDING: deque = deque()  # (question, future)
+_LLM_FLUSH_HANDLE = None
+_LLM_BATCH_TASKS: set = set()  # strong refs; the loop only keeps weak ones
+BATCH_ANSWER_PATTERN = re.compile(r"^###\s*(\d+)\s*$", re.MULTILINE)
+
+async def _generate_sql(question: str) -> Tuple[str, bool]:
+    """Return (sql, batched) where batched says the SQL came from a shared call."""
+    global _LLM_FLUSH_HANDLE
+    fut = IO_LOOP.create_future()
+    _LLM_PENDING.append((question, fut))
+    if len(_LLM_PENDING) >= LLM_BATCH_MAX or not _LLM_BATCH_TASKS:
+        _flush_llm_batch()
+    elif _LLM_FLUSH_HANDLE is None:
+        _LLM_FLUSH_HANDLE = IO_LOOP.call_later(LLM_BATCH_WINDOW, _flush_llm_batch)
+    return await fut
+
+def _flush_llm_batch() -> None:
+    global _LLM_FLUSH_HANDLE
+    if _LLM_FLUSH_HANDLE is not None:
+        _LLM_FLUSH_HANDLE.cancel()
+        _LLM_FLUSH_HANDLE = None
+    batch = [_LLM_PENDING.popleft() for _ in range(min(len(_LLM_PENDING), LLM_BATCH_MAX))]
+    if batch:
+        task = IO_LOOP.create_task(_run_llm_batch(batch))
+        _LLM_BATCH_TASKS.add(task)
+        task.add_done_callback(_LLM_BATCH_TASKS.discard)
+    if _LLM_PENDING:
+        _LLM_FLUSH_HANDLE = IO_LOOP.call_later(LLM_BATCH_WINDOW, _flush_llm_batch)
+
+async def _run_llm_batch(batch: list) -> None:
+    if len(batch) > 1:
+        try:
+            answers = await _invoke_llm_batch([q for q, _ in batch])
+        except Exception as e:
+            print("Batched Groq call failed, retrying individually:", repr(e))
+            answers = {}
+        # All-or-nothing: a skipped or renumbered answer could hand one user
+        # the SQL for another user's question.
+        if sorted(answers) == list(range(1, len(batch) + 1)):
+            for i, (_, fut) in enumerate(batch, start=1):
+                if not fut.done():
+                    fut.set_result((answers[i], True))
+            return
+        if answers:
+            print("Batched Groq answer didn't cover questions 1..N, retrying individually.")
+
+    await asyncio.gather(*(_resolve_single(q, fut) for q, fut in batch))
+
+async def _resolve_single(question: str, fut: asyncio.Future) -> None:
+    try:
+        sql = await _invoke_llm_single(question)
+    except Exception as e:
+        if not fut.done():
+            fut.set_exception(e)
+        return
+    if not fut.done():
+        fut.set_result((sql, False))
+
+async def _invoke_llm_single(question: str) -> str:
+    resp = await (SQL_PROMPT_TEMPLATE | llm).ainvoke({"question": question})
+    _log_cached_tokens(resp)
+    return _clean_sql(resp.content)
+
+async def _invoke_llm_batch(questions: list) -> Dict[int, str]:
+    # One line per question, no "#" runs: user text can't forge another answer's "### N"
+    numbered = "\n".join(
+        f"{i}. {' '.join(re.sub(r'#+', ' ', q).split())}" for i, q in enumerate(questions, start=1)
+    )
+    resp = await (SQL_BATCH_PROMPT_TEMPLATE | llm).ainvoke({"questions": numbered})
+    _log_cached_tokens(resp)
+
+    # re.split with one group -> [preamble, n1, body1, n2, body2, ...]
+    parts = BATCH_ANSWER_PATTERN.split(resp.content)
+    answers = {}
+    for num, body in zip(parts[1::2], parts[2::2]):
+        sql = _clean_sql(body)
+        if not sql or int(num) in answers:
+            return {}  # empty or duplicated answer: don't trust any of it
+        answers[int(num)] = sql
+    return answers
+
+def _log_cached_tokens(resp) -> None:
+    usage = resp.response_metadata.get("usage") or resp.response_metadata.get("token_usage") or {}
+    cached_tokens = usage.get("cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    print("Groq prompt cached_tokens:", cached_tokens)
+
+def _clean_sql(text: str) -> str:
+    sql = text.strip()
 
     if sql.startswith("```"):
         sql = sql.strip("`")
@@ -173,117 +472,223 @@ def generate_sql_for_question(question: str) -> str:
 # -----------------------------
 # 8) File save helpers
 # -----------------------------
-def save_df_to_files(df: pd.DataFrame) -> dict:
-    unique = uuid.uuid4().hex
-    csv_path = os.path.join(OUT_DIR, f"results_{unique}.csv")
-    xlsx_path = os.path.join(OUT_DIR, f"results_{unique}.xlsx")
-    df.to_csv(csv_path, index=False)
-    df.to_excel(xlsx_path, index=False)
-    return {"csv": csv_path, "excel": xlsx_path}
+STASH_TOKEN_PATTERN = re.compile(r"[0-9a-f]{32}")
+STASH_MAX_AGE = 86400  # seconds; matches the chat/issue store TTL
+
+def _stash_path(token: str) -> str:
+    # The token comes back from the session cookie: never build a path from anything else
+    if not isinstance(token, str) or not STASH_TOKEN_PATTERN.fullmatch(token):
+        raise FileNotFoundError("invalid result token")
+    return os.path.join(OUT_DIR, f"df_{token}.pkl")
+
+def stash_df(df: pd.DataFrame) -> str:
+    """Pickle the result set; CSV/Excel are only rendered when downloaded."""
+    prune_stashed_dfs()
+    token = uuid.uuid4().hex
+    df.to_pickle(_stash_path(token))
+    return token
+
+def load_stashed_df(token: str) -> pd.DataFrame:
+    return pd.read_pickle(_stash_path(token))
+
+def discard_stashed_df(token: str) -> None:
+    try:
+        os.remove(_stash_path(token))
+    except FileNotFoundError:
+        pass
+
+def prune_stashed_dfs() -> None:
+    """Delete stashed result sets older than STASH_MAX_AGE."""
+    cutoff = time.time() - STASH_MAX_AGE
+    for entry in os.scandir(OUT_DIR):
+        if not (entry.name.startswith("df_") and entry.name.endswith(".pkl")):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
 
 # -----------------------------
 # 9) Session chat helpers
 # -----------------------------
+# Chat history lives in SERVER_CHAT_STORE; the cookie only carries a small sid.
+CHAT_MAX_MESSAGES = 50
+GREETING = "👋 Hi — I'm your AI Support Bot. Ask me anything about orders, SKUs, locations, or inventory."
+
 def reset_chat():
-    session["chat"] = [
-        {"role": "assistant", "content": "👋 Hi — I'm your AI Support Bot. Ask me anything about orders, SKUs, locations, or inventory."}
-    ]
+    new_chat()
     session["state"] = "collect"
     session.pop("pending_sql", None)
-    session.pop("latest_files", None)
+    old_token = session.pop("latest_df", None)
+    if old_token:
+        discard_stashed_df(old_token)
+
+def new_chat() -> list:
+    """Start a fresh chat list for this sid without touching session state."""
+    sid = session.setdefault("sid", uuid.uuid4().hex)
+    msgs = [{"role": "assistant", "content": GREETING}]
+    with CHAT_STORE_LOCK:
+        SERVER_CHAT_STORE[sid] = msgs
+    return msgs
+
+def get_chat():
+    """Return this session's chat list, or None if it was never created or has expired."""
+    sid = session.get("sid")
+    if not sid:
+        return None
+    with CHAT_STORE_LOCK:
+        return SERVER_CHAT_STORE.get(sid)
 
 def append_message(role: str, content: str):
-    msgs = session.get("chat", [])
-    msgs.append({"role": role, "content": content})
-    session["chat"] = msgs
+    # The list can vanish (restart, TTL, another worker); recreate only the
+    # list so a pending confirmation in the cookie survives.
+    msgs = get_chat()
+    if msgs is None:
+        msgs = new_chat()
+    with CHAT_STORE_LOCK:
+        msgs.append({"role": role, "content": content})
+        del msgs[:-CHAT_MAX_MESSAGES]
 
 # -----------------------------
 # 10–12 unchanged
 # -----------------------------
-ISSUE_STORE: Dict[str, Dict[str, Any]] = {}
-SERVER_CHAT_STORE: Dict[str, list] = {}
+# Bounded so a long-running process doesn't accumulate every ticket/chat forever
+# (TTLCache isn't thread-safe, even for reads, so every access takes its lock)
+ISSUE_STORE: Dict[str, Dict[str, Any]] = TTLCache(maxsize=10_000, ttl=86400)
+ISSUE_STORE_LOCK = threading.Lock()
+SERVER_CHAT_STORE: Dict[str, list] = TTLCache(maxsize=10_000, ttl=86400)
+CHAT_STORE_LOCK = threading.Lock()
+
+# Escalation mails are sent off the request thread so the redirect isn't blocked on SMTP
+MAIL_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Logged-in SMTP connection reused across sends; guarded by _SMTP_LOCK
+_SMTP_CONN = None
+_SMTP_LOCK = threading.Lock()
 
 def send_mail_to_upstream(subject: str, body: str, to: str = None) -> bool:
     if not all([SMTP_USER, SMTP_PASS, UPSTREAM_EMAIL]):
         print("SMTP config missing. Skipping email.")
         return False
 
-    host = SMTP_HOST or "smtp.gmail.com"
-    debug = str(os.getenv("SMTP_DEBUG", "0")).strip() in {"1", "true", "yes"}
-
-    recipients = to.split(",") if to else [e.strip() for e in UPSTREAM_EMAIL.split(",") if e.strip()]
+    recipients = to.split(",") if to else UPSTREAM_RECIPIENTS
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = SMTP_USER
     msg["To"] = ", ".join(recipients)
     msg.set_content(body)
 
-    # If user explicitly set port or SSL, respect it; else try SSL:465 then STARTTLS:587
-    env_use_ssl = os.getenv("SMTP_USE_SSL")
-    env_port = os.getenv("SMTP_PORT")
-
-    attempts = []
-    if env_port or env_use_ssl is not None:
-        use_ssl = str(env_use_ssl or "").lower() in {"1", "true", "yes"}
-        port = int(env_port) if env_port else (465 if use_ssl else 587)
-        attempts.append((use_ssl, host, port))
-    else:
-        attempts.extend([
-            (True, host, 465),   # SSL first (matches working code)
-            (False, host, 587),  # STARTTLS fallback
-        ])
-
+    with _SMTP_LOCK:
+        try:
+            server = _get_smtp()
+            if server is None:
+                return False
+            try:
+                server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Cached connection died between noop() and send; reconnect once
+                _reset_smtp()
+                server = _get_smtp()
+                if server is None:
+                    return False
+                server.send_message(msg)
+        except (socket.timeout, smtplib.SMTPException, OSError) as e:
+            print("SMTP failure while sending:", repr(e))
+            _reset_smtp()
+            return False
+    print("Mail sent to upstream:", recipients)
+    return True
+
+def _open_smtp():
     errors = []
-    for use_ssl, h, p in attempts:
+    for use_ssl, h, p in SMTP_ATTEMPTS:
+        server = None
         try:
             if use_ssl:
-                with smtplib.SMTP_SSL(h, p, timeout=25) as server:
-                    if debug:
-                        server.set_debuglevel(1)
-                    server.login(SMTP_USER, SMTP_PASS)
-                    server.send_message(msg)
+                server = smtplib.SMTP_SSL(h, p, timeout=25)
+                if SMTP_DEBUG:
+                    server.set_debuglevel(1)
             else:
-                with smtplib.SMTP(h, p, timeout=25) as server:
-                    if debug:
-                        server.set_debuglevel(1)
-                    server.ehlo()
-                    server.starttls()
-                    server.ehlo()
-                    server.login(SMTP_USER, SMTP_PASS)
-                    server.send_message(msg)
-            print("Mail sent to upstream:", recipients)
-            return True
+                server = smtplib.SMTP(h, p, timeout=25)
+                if SMTP_DEBUG:
+                    server.set_debuglevel(1)
+                server.ehlo()
+                server.starttls()
+                server.ehlo()
+            server.login(SMTP_USER, SMTP_PASS)
+            return server
         except (socket.timeout, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, OSError) as e:
             errors.append(f"{h}:{p} ssl={use_ssl} -> {repr(e)}")
+            if server is not None:
+                server.close()
             continue
+        except Exception:
+            # e.g. SMTPAuthenticationError / SMTPNotSupportedError: don't leak the socket
+            if server is not None:
+                server.close()
+            raise
 
     print("SMTP failure: all attempts failed:\n" + "\n".join(errors))
-    return False
-        
-def create_and_send_issue(user_question: str, sql: str, table: str, details: str) -> Tuple[str, str, bool]:
+    return None
+
+def _get_smtp():
+    """Return the cached connection if it still answers NOOP, else reconnect. Caller holds _SMTP_LOCK."""
+    global _SMTP_CONN
+    if _SMTP_CONN is not None:
+        try:
+            _SMTP_CONN.noop()
+            return _SMTP_CONN
+        except (smtplib.SMTPServerDisconnected, OSError):
+            _reset_smtp()
+    _SMTP_CONN = _open_smtp()
+    return _SMTP_CONN
+
+def _reset_smtp() -> None:
+    global _SMTP_CONN
+    if _SMTP_CONN is not None:
+        try:
+            _SMTP_CONN.quit()
+        except (smtplib.SMTPException, OSError):
+            _SMTP_CONN.close()
+    _SMTP_CONN = None
+
+def create_and_send_issue(user_question: str, sql: str, table: str, details: str) -> Tuple[str, str]:
     issue_id = uuid.uuid4().hex[:8]
     convo_token = uuid.uuid4().hex[:12]
-    ISSUE_STORE[issue_id] = {
-        "question": user_question,
-        "sql": sql,
-        "table": table,
-        "details": details,
-        "status": "open"
-    }
+    with ISSUE_STORE_LOCK:
+        ISSUE_STORE[issue_id] = {
+            "question": user_question,
+            "sql": sql,
+            "table": table,
+            "details": details,
+            "status": "open"
+        }
     subject = f"[AI Chatbot] Missing Data Escalation — {table} ({issue_id})"
     body = f"Conversation token: {convo_token}\nUser Question: {user_question}\nSQL: {sql}\nDetails: {details}"
-    ok = send_mail_to_upstream(subject, body)
-    return issue_id, convo_token, ok
+    future = MAIL_EXECUTOR.submit(send_mail_to_upstream, subject, body)
+    # Delivery happens in the background; failures are only logged
+    future.add_done_callback(lambda f: _log_mail_result(issue_id, f))
+    return issue_id, convo_token
+
+def _log_mail_result(issue_id: str, future: Future) -> None:
+    try:
+        ok = future.result()
+    except Exception as e:
+        print(f"Escalation mail for issue {issue_id} raised: {e!r}")
+        ok = False
+    if not ok:
+        print(f"Escalation mail for issue {issue_id} was not delivered.")
 
 # -----------------------------
 # 13) Flask route (MODIFIED PART)
 # -----------------------------
 @app.route("/", methods=["GET", "POST"])
-def index():
-    if "chat" not in session:
-        reset_chat()
+async def index():
+    chat_messages = get_chat()
+    if chat_messages is None:
+        chat_messages = new_chat()
 
-    chat_messages = session.get("chat", [])
     state = session.get("state", "collect")
 
     if request.method == "POST":
@@ -308,12 +713,12 @@ def index():
 
         try:
             if state == "collect":
-                sql = generate_sql_for_question(user_text)
+                sql = await generate_sql_for_question(user_text)
                 if not is_safe_sql(sql):
                     append_message("assistant", "❌ I couldn’t generate a safe SQL for that. Please rephrase.")
                     return redirect(url_for("index"))
 
-                session["pending_sql"] = sql
+                session["pending_sql"] = ensure_limit(sql)
                 append_message("assistant", "I found a query for that. Do you want me to run it? (Yes/No)")
                 session["state"] = "confirm"
                 return redirect(url_for("index"))
@@ -321,21 +726,24 @@ def index():
             elif state == "confirm":
                 if user_text.lower() in {"yes", "y"}:
                     sql = session.get("pending_sql")
-                    df = run_sql_to_df(sql)
-                    if df.empty:
-                        issue_id, token, ok = create_and_send_issue(
+                    df = await run_sql_to_df(sql)
+                    if len(df.index) == 0:
+                        issue_id, token = create_and_send_issue(
                             user_text, sql, detect_table(user_text), "No rows returned"
                         )
-                        if ok:
-                            append_message("assistant", f"No data found. Issue **{issue_id}** escalated upstream.")
-                        else:
-                            append_message("assistant", f"No data found, but failed to send email. Issue ID: {issue_id}")
+                        append_message("assistant", f"No data found. Issue **{issue_id}** has been logged and will be escalated upstream.")
                         session["state"] = "collect"
                         return redirect(url_for("index"))
 
-                    files = save_df_to_files(df)
-                    session["latest_files"] = files
-                    preview = df.head(20).to_html(classes="table table-striped table-sm", index=False)
+                    old_token = session.get("latest_df")
+                    if old_token:
+                        discard_stashed_df(old_token)
+                    session["latest_df"] = stash_df(df)
+                    preview = render_template(
+                        "_table.html",
+                        cols=list(df.columns),
+                        rows=df.iloc[:20].itertuples(index=False, name=None),
+                    )
                     append_message("assistant", f"Here are the results:<br>{preview}")
                     append_message("assistant", f'<a href="{url_for("download_file", filetype="csv")}">Download CSV</a> | <a href="{url_for("download_file", filetype="excel")}">Download Excel</a>')
                     append_message("assistant", "Would you like to make another request or type 'close chat' to end?")
@@ -358,11 +766,26 @@ def index():
 # -----------------------------
 @app.route("/download/<filetype>")
 def download_file(filetype):
-    files = session.get("latest_files")
-    if not files or filetype not in files:
+    token = session.get("latest_df")
+    if not token or filetype not in {"csv", "excel"}:
+        flash("File not available.", "warning")
+        return redirect(url_for("index"))
+    try:
+        df = load_stashed_df(token)
+    except FileNotFoundError:
         flash("File not available.", "warning")
         return redirect(url_for("index"))
-    return send_file(files[filetype], as_attachment=True)
+
+    buf = io.BytesIO()
+    if filetype == "csv":
+        df.to_csv(buf, index=False)
+        mimetype, ext = "text/csv", "csv"
+    else:
+        # No constant_memory: pandas writes column by column, which that mode drops
+        df.to_excel(buf, index=False, engine="xlsxwriter")
+        mimetype, ext = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"
+    buf.seek(0)
+    return send_file(buf, mimetype=mimetype, as_attachment=True, download_name=f"results_{token}.{ext}")
 
 # -----------------------------
 # 15) Main entry